@@ -1,28 +1,29 @@
 import streamlit as st
 import pandas as pd
 import re
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from urllib.parse import urlencode
 import io
+import functools
 
-def update_click_url(original_url, click_tracker, campaign_name):
-    """
-    Updates the Click URL by prepending the click tracker and appending/updating UTM/TF parameters.
-    """
-    if pd.isna(original_url):
-        original_url = "" # Ensure it's a string if NaN
+# Prefer the Rust-based calamine reader for Excel uploads, which is much faster than openpyxl
+try:
+    import python_calamine # noqa: F401
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = 'openpyxl'
 
-    # Prepend click tracker if available
-    if pd.notna(click_tracker):
-        updated_url = click_tracker + original_url
-    else:
-        updated_url = original_url
+# URLs with an existing query string or fragment need their parameters merged,
+# all others can simply have the parameters appended
+NEEDS_PARSE_PATTERN = re.compile(r'[?#]')
 
-    # Parse the URL to manipulate parameters
-    parsed_url = urlparse(updated_url)
-    query_params = parse_qs(parsed_url.query)
+# Regex to find content inside single or double quotes of an impression tracker
+IMPRESSION_URL_PATTERN = r'["\'](.*?)["\']'
 
-    # Define parameters to append/update
-    params_to_add = {
+def tracking_params(campaign_name):
+    """
+    Returns the UTM/TF parameters that every TikTok Click URL should carry.
+    """
+    return {
         'utm_source': 'tiktok',
         'utm_medium': 'paid',
         'utm_campaign': campaign_name,
@@ -31,143 +32,230 @@ def update_click_url(original_url, click_tracker, campaign_name):
         'tf_campaign': campaign_name,
     }
 
-    # Append/update parameters
-    for key, value in params_to_add.items():
-        if key not in query_params:
-            query_params[key] = [value]
-        # If the parameter exists, ensure its value is correct.
-        elif query_params[key][0] != value and key in ['utm_source', 'utm_medium', 'tf_source', 'tf_medium']:
-            query_params[key] = [value]
-        # For campaign, if it exists, update it to the specific campaign_name if it's different.
-        elif (key == 'utm_campaign' or key == 'tf_campaign') and query_params[key][0] != value:
-            query_params[key] = [value]
+@functools.lru_cache(maxsize=100_000)
+def merge_tracking_params(url, campaign_name):
+    """
+    Appends/updates the UTM/TF parameters on an already tracker-prefixed URL that has a
+    query string or fragment (all other URLs simply get the parameters appended in update_urls).
+    Cached because ads in the same ad group usually repeat the same URL and campaign.
+    """
+    params_to_add = tracking_params(campaign_name)
+    new_query = urlencode(params_to_add)
+
+    # Split off the fragment, which has to stay after the query string
+    url, hash_sign, fragment = url.partition('#')
+    base_url, _, query = url.partition('?')
+
+    # Keep the existing parameters untouched, except the ones being set here
+    kept_params = [
+        param for param in query.split('&')
+        if param and param.split('=', 1)[0] not in params_to_add
+    ]
 
-    # Reconstruct the query string
-    new_query = urlencode(query_params, doseq=True)
+    return base_url + '?' + '&'.join(kept_params + [new_query]) + hash_sign + fragment
 
-    # Reconstruct the URL
-    final_url = urlunparse(parsed_url._replace(query=new_query))
+# Directly use the exact tracker column names provided by the user
+CLICK_TRACKER_COL = 'Click Tag'
+IMPRESSION_TRACKER_COL = 'Impression Tag (image)'
 
-    return final_url
+# Only the matching and tracker columns of the Tag file are used, so the rest are never parsed.
+# The TikTok file is read in full because all of its columns are written back out.
+TAG_FILE_COLUMNS = {'Campaign Name', 'Placement Name', 'Ad Name', CLICK_TRACKER_COL, IMPRESSION_TRACKER_COL}
 
-def extract_impression_url(impression_tracker_string):
+def is_tag_file_column(col):
     """
-    Extracts the URL from within quotation marks in the impression tracker string.
+    usecols filter for the Tag file. Compares stripped names, since column names are only stripped after loading.
+    """
+    return str(col).strip() in TAG_FILE_COLUMNS
+
+def require_column(df, column, file_label):
     """
-    if pd.isna(impression_tracker_string):
-        return None
-    # Regex to find content inside single or double quotes
-    match = re.search(r'["\'](.*?)["\']', impression_tracker_string)
-    if match:
-        return match.group(1)
-    return None
+    Raises a ValueError listing the available columns if the expected column is missing.
+    """
+    if column not in df.columns:
+        raise ValueError(
+            f"Expected column '{column}' not found in the {file_label}. "
+            f"Available columns are: {df.columns.tolist()}"
+        )
 
-@st.cache_data
+@st.cache_data(show_spinner=False, ttl=3600)
 def process_files(tiktok_file_buffer, tag_file_buffer):
     """
-    Core logic to process TikTok and Tag files, update URLs, and return the processed DataFrame.
-    This function is cached for performance with Streamlit.
+    Core logic to process TikTok and Tag files, update URLs, and return the processed DataFrame
+    along with the number of duplicate tag rows that were ignored.
+    Cached on the full contents of both uploads; each file's load is also cached separately,
+    so swapping only one file doesn't re-read the other.
+    """
+    df_tiktok = load_tiktok_file(tiktok_file_buffer, tiktok_file_buffer.name)
+    df_tags = load_tag_file(tag_file_buffer, tag_file_buffer.name)
+    return update_urls(df_tiktok, df_tags)
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_tiktok_file(tiktok_file_buffer, file_name):
+    """
+    Reads the TikTok export and prepares its matching columns.
     """
-    # --- Load Data ---
     # Determine file type for TikTok file and read accordingly
-    if tiktok_file_buffer.name.endswith('.csv'):
+    if file_name.endswith('.csv'):
         df_tiktok = pd.read_csv(tiktok_file_buffer)
-    elif tiktok_file_buffer.name.endswith('.xlsx'):
+    elif file_name.endswith('.xlsx'):
         # For Excel, the sheet name is 'Ads'
-        df_tiktok = pd.read_excel(tiktok_file_buffer, sheet_name='Ads')
+        df_tiktok = pd.read_excel(tiktok_file_buffer, sheet_name='Ads', engine=EXCEL_READ_ENGINE)
     else:
         raise ValueError("Unsupported TikTok file format. Please upload a .csv or .xlsx file.")
 
+    # --- Preprocessing: Clean column names and ensure consistency ---
+    # Strip whitespace from column names for robust matching
+    df_tiktok.columns = df_tiktok.columns.str.strip()
 
+    # IMPORTANT: Use 'Web URL' for TikTok file instead of 'Click URL'
+    require_column(df_tiktok, 'Web URL', 'TikTok file')
+
+    # Ensure matching and URL columns are treated as strings and fill NA for merging.
+    # Arrow-backed strings are stored compactly and let the .str operations run in Arrow kernels.
+    for col in ['Campaign Name', 'Ad Group Name', 'Ad Name', 'Web URL']:
+        df_tiktok[col] = df_tiktok[col].astype('string[pyarrow]').fillna('')
+
+    return df_tiktok
+
+def read_tag_file(tag_file_buffer, file_name, **read_options):
+    """
+    Reads the DCM Tag file with the given extra pandas read options and strips its column names.
+    """
     # Determine file type for Tag file and read accordingly
-    if tag_file_buffer.name.endswith('.csv'):
+    if file_name.endswith('.csv'):
         # Header is in row 11, so pandas header parameter should be 10 (0-indexed)
-        df_tags = pd.read_csv(tag_file_buffer, header=10)
-    elif tag_file_buffer.name.endswith('.xlsx'):
+        df_tags = pd.read_csv(tag_file_buffer, header=10, **read_options)
+    elif file_name.endswith('.xlsx'):
         # For Excel, the sheet name is 'Tracking Ads' and header is in row 11
-        df_tags = pd.read_excel(tag_file_buffer, sheet_name='Tracking Ads', header=10)
+        df_tags = pd.read_excel(
+            tag_file_buffer, sheet_name='Tracking Ads', header=10, engine=EXCEL_READ_ENGINE, **read_options
+        )
     else:
         raise ValueError("Unsupported Tag file format. Please upload a .csv or .xlsx file.")
 
-
     # --- Preprocessing: Clean column names and ensure consistency ---
     # Strip whitespace from column names for robust matching
-    df_tiktok.columns = df_tiktok.columns.str.strip()
     df_tags.columns = df_tags.columns.str.strip()
+    return df_tags
 
-    # Ensure matching columns are treated as strings and fill NA for merging
-    # TikTok columns
-    df_tiktok['Campaign Name'] = df_tiktok['Campaign Name'].astype(str).fillna('')
-    df_tiktok['Ad Group Name'] = df_tiktok['Ad Group Name'].astype(str).fillna('')
-    df_tiktok['Ad Name'] = df_tiktok['Ad Name'].astype(str).fillna('')
-    # IMPORTANT: Use 'Web URL' for TikTok file instead of 'Click URL'
-    if 'Web URL' not in df_tiktok.columns:
-        raise ValueError(
-            f"Expected column 'Web URL' not found in the TikTok file. "
-            f"Available columns are: {df_tiktok.columns.tolist()}"
-        )
-
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_tag_file(tag_file_buffer, file_name):
+    """
+    Reads the DCM Tag file and prepares its matching and tracker columns.
+    """
+    df_tags = read_tag_file(tag_file_buffer, file_name, usecols=is_tag_file_column)
 
-    # Tag file columns
-    df_tags['Campaign Name'] = df_tags['Campaign Name'].astype(str).fillna('')
-    df_tags['Placement Name'] = df_tags['Placement Name'].astype(str).fillna('')
-    df_tags['Ad Name'] = df_tags['Ad Name'].astype(str).fillna('')
+    # --- Validate Click Tracker and Impression Tracker columns ---
+    # usecols dropped every other column, so when one is missing re-read just the header
+    # to list all of the file's columns in the error
+    if CLICK_TRACKER_COL not in df_tags.columns or IMPRESSION_TRACKER_COL not in df_tags.columns:
+        tag_file_buffer.seek(0)
+        tag_header = read_tag_file(tag_file_buffer, file_name, nrows=0)
+        require_column(tag_header, CLICK_TRACKER_COL, 'Tag file')
+        require_column(tag_header, IMPRESSION_TRACKER_COL, 'Tag file')
 
-    # --- Identify Click Tracker and Impression Tracker columns ---
-    # Directly use the exact column names provided by the user
-    click_tracker_col = 'Click Tag'
-    impression_tracker_col = 'Impression Tag (image)'
+    # Ensure matching and tracker columns are treated as strings and fill NA for merging
+    for col in ['Campaign Name', 'Placement Name', 'Ad Name', CLICK_TRACKER_COL, IMPRESSION_TRACKER_COL]:
+        df_tags[col] = df_tags[col].astype('string[pyarrow]').fillna('')
 
-    # Validate that these columns exist in the DataFrame
-    if click_tracker_col not in df_tags.columns:
-        raise ValueError(
-            f"Expected column '{click_tracker_col}' not found in the Tag file. "
-            f"Available columns are: {df_tags.columns.tolist()}"
-        )
-    if impression_tracker_col not in df_tags.columns:
-        raise ValueError(
-            f"Expected column '{impression_tracker_col}' not found in the Tag file. "
-            f"Available columns are: {df_tags.columns.tolist()}"
-        )
+    return df_tags
 
-    # --- Matching Logic: Merge DataFrames ---
-    # Only select the identified tracker columns from df_tags
-    merged_df = pd.merge(
-        df_tiktok,
-        df_tags[['Campaign Name', 'Placement Name', 'Ad Name', click_tracker_col, impression_tracker_col]],
-        left_on=['Campaign Name', 'Ad Group Name', 'Ad Name'],
-        right_on=['Campaign Name', 'Placement Name', 'Ad Name'],
+def update_urls(df_tiktok, df_tags):
+    """
+    Matches the TikTok ads to their tags and updates the Click and Impression URLs.
+    Returns the updated DataFrame and the number of duplicate tag rows that were ignored.
+    """
+    # Start each run with an empty URL cache so it only holds entries for the current files
+    merge_tracking_params.cache_clear()
+
+    # --- Deduplicate Tag rows ---
+    # Keep only the first tag row per Campaign/Placement/Ad, so the join can't multiply TikTok rows
+    duplicate_tags = df_tags.duplicated(subset=['Campaign Name', 'Placement Name', 'Ad Name'], keep='first')
+    duplicate_tag_count = int(duplicate_tags.sum())
+    if duplicate_tag_count:
+        df_tags = df_tags[~duplicate_tags]
+
+    # --- Matching Logic: Join DataFrames ---
+    # Index the tag file on its matching columns and only keep the identified tracker columns,
+    # renamed to temporary names so they can't collide with TikTok columns and need no suffixes
+    joined_click_col = '__click_tag__'
+    joined_impression_col = '__impression_tag__'
+    df_tags_indexed = (
+        df_tags.set_index(['Campaign Name', 'Placement Name', 'Ad Name'])
+        [[CLICK_TRACKER_COL, IMPRESSION_TRACKER_COL]]
+        .rename(columns={CLICK_TRACKER_COL: joined_click_col, IMPRESSION_TRACKER_COL: joined_impression_col})
+    )
+    merged_df = df_tiktok.join(
+        df_tags_indexed,
+        on=['Campaign Name', 'Ad Group Name', 'Ad Name'],
         how='left',
-        suffixes=('_tiktok', '_tag') # Suffixes to differentiate columns with same names
+        validate='m:1' # Each TikTok ad must match at most one tag row
     )
+    # Fail fast rather than rewriting URLs for a blown-up frame
+    if len(merged_df) != len(df_tiktok):
+        raise ValueError(
+            f"Matching the Tag file expanded the TikTok ads from {len(df_tiktok)} to {len(merged_df)} rows. "
+            f"Check the Tag file for duplicate Campaign/Placement/Ad combinations."
+        )
 
     # --- Update Click URL (now 'Web URL' in tiktok side) ---
-    # Apply the update_click_url function row-wise
-    # Use the original 'Web URL' from TikTok and the dynamically found 'Click Tracker' from the merged data
-    # Pass 'Campaign Name' from the TikTok side for parameter population
-    merged_df['Web URL'] = merged_df.apply( # Changed from 'Click URL' to 'Web URL'
-        lambda row: update_click_url(
-            row['Web URL'], # Changed from 'Click URL' to 'Web URL'
-            row[click_tracker_col],
-            row['Campaign Name'] # Changed from 'Campaign Name_tiktok' to 'Campaign Name'
-        ),
-        axis=1
-    )
+    # Prepend the click tracker (if available) to the original 'Web URL' from TikTok
+    base_urls = merged_df[joined_click_col].fillna('') + merged_df['Web URL']
+
+    # Build the UTM/TF query string once per campaign instead of once per row
+    campaign_queries = {
+        campaign: urlencode(tracking_params(campaign))
+        for campaign in merged_df['Campaign Name'].unique()
+    }
+    query_suffix = merged_df['Campaign Name'].map(campaign_queries).astype('string[pyarrow]')
+
+    # Only URLs that need parsing go through merge_tracking_params; the rest just get the suffix appended.
+    # The tracker is already prepended, so the slow path loops over plain arrays of the selected rows only.
+    needs_merge = base_urls.str.contains(NEEDS_PARSE_PATTERN.pattern)
+    merged_df['Web URL'] = base_urls + '?' + query_suffix
+    if needs_merge.any():
+        slow_urls = base_urls[needs_merge].to_numpy(dtype=object)
+        slow_campaigns = merged_df.loc[needs_merge, 'Campaign Name'].to_numpy(dtype=object)
+        merged_df.loc[needs_merge, 'Web URL'] = [
+            merge_tracking_params(url, campaign_name)
+            for url, campaign_name in zip(slow_urls, slow_campaigns)
+        ]
 
     # --- Update Impression tracking URL ---
-    # Apply the extract_impression_url function row-wise
-    merged_df['Impression tracking URL'] = merged_df.apply(
-        lambda row: extract_impression_url(row[impression_tracker_col]),
-        axis=1
+    # Extract the quoted URL from the whole column at once
+    merged_df['Impression tracking URL'] = (
+        merged_df[joined_impression_col]
+        .str.extract(IMPRESSION_URL_PATTERN, expand=False)
     )
 
     # --- Final Output Preparation ---
-    # Drop the temporary columns introduced by the merge from the tag file
+    # Drop the temporary tracker columns joined in from the tag file
     # We only want to keep the original TikTok columns updated
-    columns_to_drop = [col for col in merged_df.columns if col.endswith('_tag') or col in [click_tracker_col, impression_tracker_col, 'Placement Name']]
-    final_df = merged_df.drop(columns=columns_to_drop, errors='ignore')
+    final_df = merged_df.drop(columns=[joined_click_col, joined_impression_col])
 
-    return final_df
+    return final_df, duplicate_tag_count
+
+def to_csv_data(df):
+    """
+    Serializes the processed DataFrame to CSV for the download button.
+    Only called when the button is clicked.
+    """
+    # Write encoded bytes directly, so the download doesn't need a second str -> bytes pass
+    csv_buffer = io.BytesIO()
+    df.to_csv(csv_buffer, index=False, encoding='utf-8')
+    return csv_buffer.getvalue()
+
+def to_excel_data(df):
+    """
+    Serializes the processed DataFrame to XLSX for the download button.
+    Only called when the button is clicked.
+    """
+    excel_buffer = io.BytesIO()
+    # xlsxwriter is considerably faster than openpyxl for writing
+    with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name='Updated Ads')
+    return excel_buffer.getvalue()
 
 # --- Streamlit App Interface ---
 st.set_page_config(page_title="TikTok Tag Updater", layout="centered")
@@ -192,29 +280,33 @@ if tiktok_file and tag_file:
     if st.button("Process Files"):
         with st.spinner("Processing files... This might take a moment."):
             try:
-                updated_df = process_files(tiktok_file, tag_file)
+                updated_df, duplicate_tag_count = process_files(tiktok_file, tag_file)
                 st.success("Files processed successfully!")
+                if duplicate_tag_count:
+                    st.info(
+                        f"Dropped {duplicate_tag_count} duplicate tag rows; the first tag row was used "
+                        f"for each Campaign/Placement/Ad combination."
+                    )
 
                 # Provide download button for CSV
-                csv_buffer = io.StringIO()
-                updated_df.to_csv(csv_buffer, index=False)
+                # Files are only serialized when their button is clicked, and clicking doesn't
+                # rerun the script so the results (and the other button) stay on the page
                 st.download_button(
                     label="Download Updated TikTok Ads CSV",
-                    data=csv_buffer.getvalue(),
+                    data=functools.partial(to_csv_data, updated_df),
                     file_name="Updated_TikTok_Ads.csv",
                     mime="text/csv",
+                    on_click="ignore",
                     help="Click to download the updated TikTok Ads file in CSV format."
                 )
 
                 # Provide download button for Excel
-                excel_buffer = io.BytesIO()
-                updated_df.to_excel(excel_buffer, index=False, sheet_name='Updated Ads')
-                excel_buffer.seek(0)
                 st.download_button(
                     label="Download Updated TikTok Ads XLSX",
-                    data=excel_buffer.getvalue(),
+                    data=functools.partial(to_excel_data, updated_df),
                     file_name="Updated_TikTok_Ads.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    on_click="ignore",
                     help="Click to download the updated TikTok Ads file in XLSX format."
                 )
 